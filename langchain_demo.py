@@ -1,5 +1,4 @@
 from langchain_openai import ChatOpenAI
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, AIMessage
 import uuid
 import os
@@ -1,13 +1,18 @@
 from fastapi import FastAPI, HTTPException, Depends, Request
 from pydantic import BaseModel
 from typing import List, Optional
+import anyio
+import asyncio
 import logging
+import os
+import sys
 import time
-import json
 import uuid
+import httpx
+import orjson
 
-from pii_vault import PIIVault
-from security_scanner import SecurityScanner
+from pii_vault import get_vault
+from security_scanner import get_scanner
 
 # Configure logging
 # We want a structured logger for audit trails
@@ -18,17 +23,82 @@ logger = logging.getLogger("audit_logger")
 
 app = FastAPI(title="Enterprise LLM Security Gateway", version="1.1.0")
 
+# Upstream LLM (OpenAI-compatible). If not configured, the mock LLM is used.
+LLM_API_BASE = os.getenv("LLM_API_BASE")
+LLM_API_KEY = os.getenv("LLM_API_KEY", "")
+
+# Audit events are queued and written in batches of up to AUDIT_LOG_BATCH_SIZE,
+# at most AUDIT_LOG_FLUSH_MS after the first queued event.
+# They go to their own stream as plain JSON lines: AUDIT_LOG_PATH if set, else stdout.
+AUDIT_LOG_PATH = os.getenv("AUDIT_LOG_PATH")
+AUDIT_LOG_QUEUE_SIZE = 10_000
+AUDIT_LOG_BATCH_SIZE = 100
+AUDIT_LOG_FLUSH_MS = 50
+
+# Worker threads available to the CPU-bound vault calls (anyio's default is 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "256"))
+
 # Global instances (loaded on startup)
 security_scanner = None
 pii_vault = None
+http_client = None
+audit_queue: Optional[asyncio.Queue] = None
+audit_task = None
+audit_dropped = 0
+audit_stream = sys.stdout
+# Put on the audit queue at shutdown to stop the writer task
+AUDIT_LOG_STOP = object()
 
 @app.on_event("startup")
 async def startup_event():
-    global security_scanner, pii_vault
-    logger.info(json.dumps({"event": "startup", "message": "Starting up Enterprise LLM Security Gateway..."}))
-    security_scanner = SecurityScanner()
-    pii_vault = PIIVault()
-    logger.info(json.dumps({"event": "startup", "message": "Security Gateway is ready."}))
+    global security_scanner, pii_vault, http_client, audit_queue, audit_task, audit_stream
+    logger.info(orjson.dumps({"event": "startup", "message": "Starting up Enterprise LLM Security Gateway..."}).decode())
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Model loading is blocking, keep it off the event loop
+    security_scanner = await asyncio.to_thread(get_scanner)
+    pii_vault = await asyncio.to_thread(get_vault)
+    # Models load lazily; load them now so the first request does not pay for it
+    await asyncio.to_thread(security_scanner.load)
+    await asyncio.to_thread(pii_vault.load)
+    # Shared async client so LLM calls reuse pooled connections.
+    # HTTP/2 multiplexes concurrent calls over a few TLS connections.
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=2000, max_keepalive_connections=1500),
+        timeout=httpx.Timeout(120.0),
+    )
+    if AUDIT_LOG_PATH:
+        audit_stream = open(AUDIT_LOG_PATH, "a", encoding="utf-8")
+    audit_queue = asyncio.Queue(maxsize=AUDIT_LOG_QUEUE_SIZE)
+    audit_task = asyncio.create_task(audit_log_writer(audit_queue))
+    logger.info(orjson.dumps({"event": "startup", "message": "Security Gateway is ready."}).decode())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global http_client, audit_queue, audit_task, audit_stream
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    if security_scanner is not None:
+        await security_scanner.aclose()
+    if pii_vault is not None:
+        # Write out mappings still pending in the vault's flush buffer.
+        # The vault is shared process-wide, so it is flushed rather than closed.
+        await asyncio.to_thread(pii_vault.flush)
+    if audit_task is not None:
+        # Let the writer finish its current batch and exit before touching the stream
+        await audit_queue.put(AUDIT_LOG_STOP)
+        await audit_task
+        audit_task = None
+        # Write whatever was queued after the stop marker
+        batch = []
+        while not audit_queue.empty():
+            batch.append(audit_queue.get_nowait())
+        write_audit_batch(batch)
+        audit_queue = None
+    if audit_stream is not sys.stdout:
+        audit_stream.close()
+        audit_stream = sys.stdout
 
 class ChatMessage(BaseModel):
     role: str
@@ -48,25 +118,107 @@ class ChatCompletionResponse(BaseModel):
     model: str
     choices: List[dict]
 
-def mock_llm_call(prompt: str) -> str:
+class UpstreamLLMError(Exception):
+    """
+    The upstream LLM returned a response the gateway cannot use.
+    """
+
+async def mock_llm_call(prompt: str) -> str:
     """
     Simulate a call to an external LLM.
     """
-    # Simulate network latency
-    time.sleep(0.5)
+    # Simulate network latency without blocking the event loop
+    await asyncio.sleep(0.5)
     return f"Echoing your sanitized prompt: {prompt}"
 
+async def llm_call(prompt: str, model: str) -> str:
+    """
+    Forward the sanitized prompt to the upstream LLM.
+    Falls back to the mock LLM when LLM_API_BASE is not set.
+    Raises UpstreamLLMError if the reply is not a chat completion with text content.
+    """
+    if not LLM_API_BASE:
+        return await mock_llm_call(prompt)
+
+    response = await http_client.post(
+        f"{LLM_API_BASE.rstrip('/')}/chat/completions",
+        json={"model": model, "messages": [{"role": "user", "content": prompt}]},
+        headers={"Authorization": f"Bearer {LLM_API_KEY}"},
+    )
+    response.raise_for_status()
+    try:
+        content = orjson.loads(response.content)["choices"][0]["message"]["content"]
+    except (orjson.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+        raise UpstreamLLMError(f"Malformed upstream response: {type(e).__name__}") from e
+    if not isinstance(content, str):
+        # e.g. tool-call replies, whose content is null
+        raise UpstreamLLMError("Upstream response has no text content")
+    return content
+
 def log_audit(event_type: str, request_id: str, details: dict):
     """
     Helper to log structured audit events.
     """
+    global audit_dropped
     log_entry = {
         "timestamp": time.time(),
         "request_id": request_id,
         "event_type": event_type,
         **details
     }
-    logger.info(json.dumps(log_entry))
+    if audit_queue is None:
+        # Writer not running (e.g. outside the app lifecycle), write directly
+        write_audit_batch([log_entry])
+        return
+    try:
+        audit_queue.put_nowait(log_entry)
+    except asyncio.QueueFull:
+        audit_dropped += 1
+
+def write_audit_batch(batch: List[dict]):
+    """
+    Write a batch of audit events to the audit stream, one JSON object per line.
+    """
+    global audit_dropped
+    if audit_dropped:
+        batch.append({"timestamp": time.time(), "event_type": "audit_log_dropped", "count": audit_dropped})
+        audit_dropped = 0
+    if batch:
+        audit_stream.write("".join(orjson.dumps(entry).decode() + "\n" for entry in batch))
+        audit_stream.flush()
+
+async def audit_log_writer(queue: asyncio.Queue):
+    """
+    Background task: drain the audit queue and write events in batches,
+    until AUDIT_LOG_STOP is received.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        entry = await queue.get()
+        if entry is AUDIT_LOG_STOP:
+            return
+        batch = [entry]
+        stop = False
+        deadline = loop.time() + AUDIT_LOG_FLUSH_MS / 1000
+        while len(batch) < AUDIT_LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                entry = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if entry is AUDIT_LOG_STOP:
+                stop = True
+                break
+            batch.append(entry)
+        try:
+            write_audit_batch(batch)
+        except Exception as e:
+            # Keep draining so one bad batch (disk full, unserializable detail) does not stop the audit trail
+            logger.error(f"Failed to write {len(batch)} audit events: {e}")
+        if stop:
+            return
 
 @app.post("/chat/completions", response_model=ChatCompletionResponse)
 async def chat_completions(request: ChatCompletionRequest, raw_request: Request):
@@ -74,7 +226,7 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
     Secure Chat Completion Endpoint.
     1. Scans for malicious content.
     2. Anonymizes PII.
-    3. Forwards to (Mock) LLM.
+    3. Forwards to the LLM (mock unless LLM_API_BASE is set).
     4. Deanonymizes response.
     """
     request_id = str(uuid.uuid4())
@@ -93,7 +245,8 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
     user_prompt = last_message.content
 
     # Step 1: Security Scan
-    is_safe = security_scanner.scan(user_prompt)
+    # Concurrent scans are micro-batched into a single model forward pass
+    is_safe = await security_scanner.scan_async(user_prompt)
     if not is_safe:
         log_audit("security_alert", request_id, {"action": "blocked", "reason": "malicious_content", "session_id": session_id})
         raise HTTPException(status_code=403, detail="Security Alert: Malicious prompt detected.")
@@ -101,18 +254,23 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
     log_audit("security_scan", request_id, {"status": "passed", "session_id": session_id})
 
     # Step 2: Anonymize PII (Session Scoped)
-    sanitized_prompt = pii_vault.anonymize(user_prompt, session_id)
+    # The vault is CPU-bound, run it on the sized anyio thread pool
+    sanitized_prompt = await anyio.to_thread.run_sync(pii_vault.anonymize, user_prompt, session_id)
     
     if sanitized_prompt != user_prompt:
         log_audit("pii_redaction", request_id, {"status": "redacted", "session_id": session_id})
     else:
         log_audit("pii_redaction", request_id, {"status": "no_pii_detected", "session_id": session_id})
 
-    # Step 3: Forward to LLM (Mock)
-    llm_raw_response = mock_llm_call(sanitized_prompt)
+    # Step 3: Forward to LLM
+    try:
+        llm_raw_response = await llm_call(sanitized_prompt, request.model)
+    except (httpx.HTTPError, UpstreamLLMError) as e:
+        log_audit("llm_error", request_id, {"error": type(e).__name__, "session_id": session_id})
+        raise HTTPException(status_code=502, detail="Upstream LLM request failed.")
     
     # Step 4: Deanonymize Response (Session Scoped)
-    final_response_text = pii_vault.deanonymize(llm_raw_response, session_id)
+    final_response_text = await anyio.to_thread.run_sync(pii_vault.deanonymize, llm_raw_response, session_id)
     
     log_audit("response_sent", request_id, {"status": "success", "session_id": session_id})
     
@@ -1,42 +1,246 @@
+import hashlib
+import heapq
+import os
+import re
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from typing import Dict, List, Optional
 from presidio_analyzer import AnalyzerEngine
+from presidio_analyzer.nlp_engine import NlpEngineProvider
 from presidio_anonymizer import AnonymizerEngine
 from presidio_anonymizer.entities import OperatorConfig
 import diskcache
 from faker import Faker
 import logging
 
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional, PlaceholderMatcher falls back to a regex
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 
+# spaCy pipeline used by Presidio for NER. en_spacy_pii_fast is a small CNN model
+# trained for PII; set PII_SPACY_MODEL=en_core_web_lg to use the large general model.
+PII_SPACY_MODEL = os.getenv("PII_SPACY_MODEL", "en_spacy_pii_fast")
+
+# Process-wide vault shared by the gateway and the LangChain integration, see get_vault()
+_VAULT = None
+_VAULT_LOCK = threading.Lock()
+
+# Returned by PIIVault._get_session_map when the session left memory after _load_session checked it
+_RELOAD = object()
+
+def get_vault() -> "PIIVault":
+    """
+    Return the shared PIIVault, creating it on first use.
+    """
+    global _VAULT
+    with _VAULT_LOCK:
+        if _VAULT is None:
+            _VAULT = PIIVault()
+        return _VAULT
+
+class PlaceholderMatcher:
+    """
+    Multi-pattern matcher that maps placeholders back to their original values.
+    Backed by an Aho-Corasick automaton (or a single regex alternation when
+    pyahocorasick is not installed), so text is scanned in a single pass
+    regardless of how many placeholders the session has.
+    """
+
+    def __init__(self, mapping: Dict[str, str]):
+        """
+        Args:
+            mapping: Placeholder -> original value.
+        """
+        self.is_empty = not mapping
+        self.max_length = max((len(p) for p in mapping), default=0)
+        self.automaton = None
+        self.pattern = None
+        if self.is_empty:
+            return
+
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for placeholder, original_value in mapping.items():
+                self.automaton.add_word(placeholder, (placeholder, original_value))
+            self.automaton.make_automaton()
+        else:
+            # Longest first so a placeholder never shadows a longer one sharing its prefix
+            self.mapping = dict(mapping)
+            self.pattern = re.compile("|".join(re.escape(p) for p in sorted(mapping, key=len, reverse=True)))
+
+    def finditer(self, text: str):
+        """
+        Yield (start, end, original_value) for each placeholder in the text,
+        left to right, preferring the longest placeholder at each position.
+        """
+        if self.is_empty:
+            return
+        if self.pattern is not None:
+            for match in self.pattern.finditer(text):
+                yield match.start(), match.end(), self.mapping[match.group(0)]
+            return
+        # iter() reports every (possibly overlapping) match; pick leftmost-longest
+        # non-overlapping ones, the same result as the longest-first regex.
+        # (iter_long is not used: it drops shorter matches nested in a failed longer one.)
+        matches = sorted(
+            (end_index - len(placeholder) + 1, -len(placeholder), original_value)
+            for end_index, (placeholder, original_value) in self.automaton.iter(text)
+        )
+        cursor = 0
+        for start, neg_length, original_value in matches:
+            if start < cursor:
+                continue
+            cursor = start - neg_length
+            yield start, cursor, original_value
+
+    def sub(self, text: str) -> str:
+        """
+        Replace every placeholder in the text with its original value.
+        """
+        if self.pattern is not None:
+            return self.pattern.sub(lambda match: self.mapping[match.group(0)], text)
+        parts = []
+        cursor = 0
+        for start, end, original_value in self.finditer(text):
+            parts.append(text[cursor:start])
+            parts.append(original_value)
+            cursor = end
+        parts.append(text[cursor:])
+        return "".join(parts)
+
+class StreamingDeanonymizer:
+    """
+    Incrementally deanonymizes text that arrives in chunks (e.g. a streamed LLM response).
+    Holds back just enough trailing characters to catch placeholders split across chunks.
+    """
+
+    def __init__(self, matcher: PlaceholderMatcher):
+        self.matcher = matcher
+        self.buffer = ""
+
+    def feed(self, chunk: str) -> str:
+        """
+        Add a chunk and return the deanonymized text that is now safe to emit.
+        """
+        self.buffer += chunk
+        # A placeholder starting at or after `cut` may still be incomplete.
+        # Any placeholder starting before it ends within the buffer, so its longest match is final.
+        cut = max(0, len(self.buffer) - self.matcher.max_length + 1)
+        parts = []
+        cursor = 0
+        for start, end, original_value in self.matcher.finditer(self.buffer):
+            if start >= cut:
+                break
+            parts.append(self.buffer[cursor:start])
+            parts.append(original_value)
+            cursor = end
+        cut = max(cut, cursor)
+        parts.append(self.buffer[cursor:cut])
+        self.buffer = self.buffer[cut:]
+        return "".join(parts)
+
+    def flush(self) -> str:
+        """
+        Return the deanonymized remainder once the stream has ended.
+        """
+        text = self.matcher.sub(self.buffer)
+        self.buffer = ""
+        return text
+
 class PIIVault:
     """
     A secure vault for anonymizing and deanonymizing Personally Identifiable Information (PII).
     Uses Microsoft Presidio for detection and replacement.
     Features:
-    - Disk-based persistence with TTL (via diskcache).
+    - In-memory session mappings, persisted to disk in batches with TTL (via diskcache).
     - Smarter anonymization using Faker for realistic placeholders.
     - Session-scoped storage to prevent cross-talk and improve performance.
     """
 
-    def __init__(self, cache_dir: str = "./pii_cache", ttl_seconds: int = 1800):
+    def __init__(
+        self,
+        cache_dir: str = "./pii_cache",
+        ttl_seconds: int = 1800,
+        flush_interval: float = 0.5,
+        analyze_cache_size: int = 4096,
+        max_sessions: int = 10000,
+    ):
         """
         Initialize the PII Vault with Presidio Analyzer and Anonymizer.
         
         Args:
             cache_dir: Directory to store the disk cache.
             ttl_seconds: Time-to-live for cached mappings in seconds (default: 30 mins).
+            flush_interval: Seconds between background flushes of new mappings to disk.
+            analyze_cache_size: Number of analyzer results kept in the LRU cache (0 disables it).
+            max_sessions: Number of sessions kept in memory; least recently used ones already on disk are evicted beyond it.
         """
-        self.analyzer = AnalyzerEngine()
+        # Presidio's spaCy pipeline is loaded on first use, see `load`
+        self.analyzer = None
+        self._analyzer_lock = threading.Lock()
         self.anonymizer = AnonymizerEngine()
+        # LRU cache of analyzer results keyed by (text hash, entities), see _analyze
+        self._analyze_cache: "OrderedDict[tuple, list]" = OrderedDict()
+        self._analyze_cache_size = analyze_cache_size
+        self._analyze_cache_lock = threading.Lock()
         # Use 'en_IN' for Indian names
         self.fake = Faker(['en_IN', 'en_US'])
         
         # Initialize DiskCache
         self.vault_storage = diskcache.Cache(cache_dir, size_limit=1024 * 1024 * 100) # 100MB limit
         self.ttl_seconds = ttl_seconds
+
+        # In-memory mappings: session_id -> {placeholder: original}, in LRU order, with expiry timestamps.
+        # Sessions touched since the last flush are written to disk by a background thread.
+        self._mem: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._expiry: Dict[str, float] = {}
+        # Min-heap of (expiry, session_id) so pruning only visits expired entries.
+        # Entries whose expiry has since moved are skipped when popped.
+        self._expiry_heap: List[tuple] = []
+        self._max_sessions = max_sessions
+        self._dirty = set()
+        self._lock = threading.Lock()
+        # session_id -> (session map, its size, matcher built from it)
+        self._matchers: Dict[str, tuple] = {}
+        self._flush_interval = flush_interval
+        self._stop_event = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="pii-vault-flusher", daemon=True)
+        self._flusher.start()
         logger.info(f"PII Vault initialized with DiskCache at {cache_dir}, TTL: {ttl_seconds}s")
 
+    def load(self):
+        """
+        Create the Presidio analyzer (loads the spaCy model). Runs once; `anonymize`
+        calls it on first use, and servers can call it at startup.
+        """
+        if self.analyzer is not None:
+            return
+        with self._analyzer_lock:
+            if self.analyzer is not None:
+                return
+            provider = NlpEngineProvider(nlp_configuration={
+                "nlp_engine_name": "spacy",
+                "models": [{"lang_code": "en", "model_name": PII_SPACY_MODEL}],
+                "ner_model_configuration": {
+                    # en_spacy_pii_fast labels people as PER, en_core_web_* as PERSON
+                    "model_to_presidio_entity_mapping": {
+                        "PER": "PERSON",
+                        "PERSON": "PERSON",
+                        "LOC": "LOCATION",
+                        "GPE": "LOCATION",
+                        "ORG": "ORGANIZATION",
+                        "NRP": "NRP",
+                        "DATE_TIME": "DATE_TIME",
+                    },
+                },
+            })
+            self.analyzer = AnalyzerEngine(nlp_engine=provider.create_engine())
+
     def _generate_fake_data(self, entity_type: str) -> str:
         """
         Generate realistic fake data based on entity type.
@@ -52,6 +256,29 @@ class PIIVault:
         else:
             return f"<{entity_type}_{str(uuid.uuid4())[:8]}>"
 
+    def _analyze(self, text: str, entities: List[str]) -> list:
+        """
+        Run the Presidio analyzer, reusing cached results for previously seen texts.
+        Only the detected spans are cached; placeholders are still generated per call.
+        """
+        key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), tuple(entities))
+        with self._analyze_cache_lock:
+            cached = self._analyze_cache.get(key)
+            if cached is not None:
+                self._analyze_cache.move_to_end(key)
+                return list(cached)
+
+        self.load()
+        results = self.analyzer.analyze(text=text, entities=entities, language='en')
+
+        if self._analyze_cache_size > 0:
+            with self._analyze_cache_lock:
+                self._analyze_cache[key] = list(results)
+                self._analyze_cache.move_to_end(key)
+                while len(self._analyze_cache) > self._analyze_cache_size:
+                    self._analyze_cache.popitem(last=False)
+        return results
+
     def anonymize(self, text: str, session_id: str) -> str:
         """
         Analyze the text for PII and replace detected entities with realistic placeholders.
@@ -65,43 +292,54 @@ class PIIVault:
             The anonymized text with placeholders.
         """
         entities = ["PHONE_NUMBER", "EMAIL_ADDRESS", "PERSON", "CREDIT_CARD"]
-        results = self.analyzer.analyze(text=text, entities=entities, language='en')
-        results.sort(key=lambda x: x.start, reverse=True)
+        results = self._analyze(text, entities)
+        results.sort(key=lambda x: (x.start, -x.end))
+
+        # Merge overlapping detections (e.g. a PERSON inside an EMAIL_ADDRESS) into one span
+        # covering all of them, typed by the earliest, longest one, so no part is left unredacted.
+        spans = []
+        for result in results:
+            if spans and result.start < spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], result.end)
+            else:
+                spans.append([result.start, result.end, result.entity_type])
         
-        anonymized_text_list = list(text)
+        # Build the output from slices in one forward walk
+        parts = []
+        cursor = 0
         
         # Track new mappings for this request
         new_mappings = {}
 
-        for result in results:
-            entity_type = result.entity_type
-            start = result.start
-            end = result.end
+        for start, end, entity_type in spans:
             original_value = text[start:end]
             
             # Generate a realistic placeholder
             placeholder = self._generate_fake_data(entity_type)
             
             # Store mapping: Placeholder -> Original
-            # Key: session:{session_id}:{placeholder}
-            key = f"session:{session_id}:{placeholder}"
-            self.vault_storage.set(key, original_value, expire=self.ttl_seconds)
-            
             new_mappings[placeholder] = original_value
             
             # Replace in text
-            anonymized_text_list[start:end] = list(placeholder)
+            parts.append(text[cursor:start])
+            parts.append(placeholder)
+            cursor = end
             
-        # Update the list of keys for this session
-        # Key: session:{session_id}:keys
-        # We need to lock or handle concurrency if multiple requests come for same session?
-        # For MVP, simple read-modify-write is okay (DiskCache is process-safe but race conditions possible).
-        session_keys_key = f"session:{session_id}:keys"
-        current_keys = self.vault_storage.get(session_keys_key, default=[])
-        current_keys.extend(new_mappings.keys())
-        self.vault_storage.set(session_keys_key, current_keys, expire=self.ttl_seconds)
+        parts.append(text[cursor:])
+
+        # Update the session mapping in memory only; the flusher persists it to disk.
+        stored = self._load_session(session_id)
+        while True:
+            with self._lock:
+                session_map = self._get_session_map(session_id, stored)
+                if session_map is not _RELOAD:
+                    session_map.update(new_mappings)
+                    self._set_expiry(session_id, time.time() + self.ttl_seconds)
+                    self._dirty.add(session_id)
+                    break
+            stored = self._load_session(session_id)
 
-        return "".join(anonymized_text_list)
+        return "".join(parts)
 
     def deanonymize(self, text: str, session_id: str) -> str:
         """
@@ -114,24 +352,209 @@ class PIIVault:
         Returns:
             The text with original PII restored.
         """
-        deanonymized_text = text
-        
-        # Get all placeholders for this session
-        session_keys_key = f"session:{session_id}:keys"
-        session_placeholders = self.vault_storage.get(session_keys_key, default=[])
-        
-        # Iterate only over the placeholders relevant to this session
-        for placeholder in session_placeholders:
-            if placeholder in deanonymized_text:
-                key = f"session:{session_id}:{placeholder}"
-                original_value = self.vault_storage.get(key)
-                if original_value:
-                    deanonymized_text = deanonymized_text.replace(placeholder, original_value)
-                
-        return deanonymized_text
+        # Replace all placeholders relevant to this session in a single pass
+        return self._get_matcher(session_id).sub(text)
+
+    def streaming_deanonymizer(self, session_id: str) -> StreamingDeanonymizer:
+        """
+        Create a deanonymizer for a response that arrives in chunks.
+
+        Args:
+            session_id: Unique identifier for the user session.
+
+        Returns:
+            A StreamingDeanonymizer over the session's current placeholders.
+        """
+        return StreamingDeanonymizer(self._get_matcher(session_id))
+
+    def _get_matcher(self, session_id: str) -> PlaceholderMatcher:
+        """
+        Return the placeholder matcher for a session, rebuilding it only when
+        the session's mapping has changed since it was built.
+        """
+        stored = self._load_session(session_id)
+        while True:
+            with self._lock:
+                session_map = self._get_session_map(session_id, stored, create=False)
+                if session_map is None:
+                    # Nothing stored for this session, don't cache an empty entry for it
+                    return PlaceholderMatcher({})
+                if session_map is not _RELOAD:
+                    cached = self._matchers.get(session_id)
+                    if cached is not None and cached[0] is session_map and cached[1] == len(session_map):
+                        return cached[2]
+                    snapshot = dict(session_map)
+                    break
+            stored = self._load_session(session_id)
+
+        matcher = PlaceholderMatcher(snapshot)
+        with self._lock:
+            # Don't cache a matcher for a session evicted meanwhile
+            if self._mem.get(session_id) is session_map:
+                self._matchers[session_id] = (session_map, len(snapshot), matcher)
+        return matcher
+
+    def _load_session(self, session_id: str) -> Optional[tuple]:
+        """
+        Read a session's mapping from disk if it is not live in memory.
+        Runs without holding self._lock so disk I/O never blocks other sessions.
+
+        Returns:
+            (mapping, expire_time) read from disk, or None if the session is already in memory.
+        """
+        with self._lock:
+            expiry = self._expiry.get(session_id)
+            if expiry is not None and expiry > time.time():
+                return None
+        return self.vault_storage.get(f"session:{session_id}", default={}, expire_time=True)
+
+    def _get_session_map(
+        self, session_id: str, stored: Optional[tuple] = None, create: bool = True
+    ):
+        """
+        Return the in-memory mapping for a session, inserting `stored` (from `_load_session`) on a miss.
+        With create=False, a miss with nothing stored returns None instead of inserting an empty map.
+        Returns _RELOAD if the session was in memory when `_load_session` ran (stored is None) but has
+        since been evicted or expired; the caller must call `_load_session` again and retry.
+        Expired sessions are purged lazily here. Caller must hold self._lock.
+        """
+        expiry = self._expiry.get(session_id)
+        if expiry is not None and expiry <= time.time():
+            self._drop_session(session_id)
+            expiry = None
+
+        if expiry is None:
+            if stored is None:
+                return _RELOAD
+            # Another thread may have loaded it meanwhile; only insert on a real miss
+            mapping, expire_time = stored
+            if not mapping and not create:
+                return None
+            self._mem[session_id] = dict(mapping)
+            self._set_expiry(session_id, expire_time or time.time() + self.ttl_seconds)
+
+        self._mem.move_to_end(session_id)
+        return self._mem[session_id]
+
+    def _set_expiry(self, session_id: str, expiry: float):
+        """
+        Record a session's expiry time. Caller must hold self._lock.
+        """
+        self._expiry[session_id] = expiry
+        heapq.heappush(self._expiry_heap, (expiry, session_id))
+
+    def _drop_session(self, session_id: str):
+        """
+        Remove a session from memory. Caller must hold self._lock.
+        """
+        self._mem.pop(session_id, None)
+        self._expiry.pop(session_id, None)
+        self._dirty.discard(session_id)
+        self._matchers.pop(session_id, None)
+
+    def _prune_expired(self):
+        """
+        Drop expired sessions from memory. Caller must hold self._lock.
+        """
+        now = time.time()
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            _, session_id = heapq.heappop(heap)
+            expiry = self._expiry.get(session_id)
+            if expiry is not None and expiry <= now:
+                self._drop_session(session_id)
+        # Every anonymize pushes a new entry; rebuild once stale ones dominate
+        if len(heap) > 2 * len(self._expiry) + 1024:
+            self._expiry_heap = [(expiry, session_id) for session_id, expiry in self._expiry.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _evict_clean(self):
+        """
+        Evict least recently used sessions beyond max_sessions. Only sessions with no
+        pending writes are evicted; they are reloaded from disk on next use.
+        Caller must hold self._lock.
+        """
+        excess = len(self._mem) - self._max_sessions
+        if excess <= 0:
+            return
+        evict = []
+        for session_id in self._mem:
+            if len(evict) == excess:
+                break
+            if session_id not in self._dirty:
+                evict.append(session_id)
+        for session_id in evict:
+            self._drop_session(session_id)
+
+    def flush(self):
+        """
+        Persist all sessions modified since the last flush in a single disk transaction.
+        """
+        with self._lock:
+            self._prune_expired()
+            # Sessions flushed by earlier calls are on disk and may be evicted; this batch is not yet
+            self._evict_clean()
+            pending = {
+                session_id: (dict(self._mem[session_id]), self._expiry[session_id])
+                for session_id in self._dirty
+            }
+            self._dirty.clear()
+
+        if not pending:
+            return
+
+        # Merge with what is on disk inside the transaction, so other processes
+        # sharing the cache directory never lose mappings to a concurrent flush.
+        now = time.time()
+        merged = {}
+        try:
+            with self.vault_storage.transact():
+                for session_id, (mapping, expiry) in pending.items():
+                    key = f"session:{session_id}"
+                    stored = self.vault_storage.get(key, default={})
+                    stored.update(mapping)
+                    self.vault_storage.set(key, stored, expire=max(expiry - now, 1))
+                    merged[session_id] = stored
+        except Exception:
+            # The transaction was rolled back (e.g. diskcache.Timeout), retry these on the next flush
+            with self._lock:
+                self._dirty.update(session_id for session_id in pending if session_id in self._mem)
+            raise
+
+        # Pick up mappings written by other processes
+        with self._lock:
+            for session_id, stored in merged.items():
+                session_map = self._mem.get(session_id)
+                if session_map is not None:
+                    for placeholder, original_value in stored.items():
+                        session_map.setdefault(placeholder, original_value)
+
+    def _flush_loop(self):
+        """
+        Background thread: flush pending mappings every flush_interval seconds.
+        """
+        while not self._stop_event.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush PII Vault to disk: {e}")
+
+    def close(self):
+        """
+        Stop the background flusher and write any pending mappings to disk.
+        """
+        self._stop_event.set()
+        self._flusher.join()
+        self.flush()
 
     def clear_storage(self):
         """
         Clear the storage.
         """
+        with self._lock:
+            self._mem.clear()
+            self._matchers.clear()
+            self._expiry.clear()
+            self._expiry_heap.clear()
+            self._dirty.clear()
         self.vault_storage.clear()
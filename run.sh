@@ -10,12 +10,14 @@ echo "Installing Python dependencies..."
 pip install -r requirements.txt
 
 # 2. Download Spacy Model for Presidio
-echo "Downloading Spacy model (en_core_web_lg)..."
-python -m spacy download en_core_web_lg
+# Installed here rather than at runtime so the server never fetches models on startup.
+echo "Downloading Spacy model (en_spacy_pii_fast)..."
+pip install https://huggingface.co/beki/en_spacy_pii_fast/resolve/main/en_spacy_pii_fast-any-py3-none-any.whl
 
 # 3. Start the Server
 echo "Starting FastAPI Server..."
 # Use uvicorn to run the app. 
 # --reload enables auto-reload on code changes (useful for dev).
 # --host 0.0.0.0 allows external access if needed.
-uvicorn main:app --host 0.0.0.0 --port 8000 --reload
+# --loop uvloop --http httptools use the faster event loop and HTTP parser.
+uvicorn main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --reload
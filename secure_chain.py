@@ -1,16 +1,18 @@
+import hashlib
 import uuid
-from typing import Dict, Any, List, Union
-from langchain_core.runnables import RunnableLambda, RunnableSerializable
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+from typing import Dict, Any, AsyncIterator, Iterator, List, Optional, Union
+from langchain_core.runnables import RunnableGenerator, RunnableLambda, RunnableSerializable
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessageChunk, SystemMessage
 from langchain_core.language_models import BaseChatModel
 import logging
 
-from pii_vault import PIIVault
-from security_scanner import SecurityScanner
+from pii_vault import PIIVault, get_vault
+from security_scanner import SecurityScanner, get_scanner
 
-# Configure logging
 logger = logging.getLogger("secure_chain")
-logging.basicConfig(level=logging.INFO)
+
+# additional_kwargs key under which input_guard records a message's anonymized content
+PII_SCANNED_KEY = "_pii_scanned"
 
 class SecureChainFactory:
     """
@@ -18,12 +20,25 @@ class SecureChainFactory:
     Wraps an LLM with:
     1. Security Scanning (Input Guard)
     2. PII Anonymization (Input Transform)
-    3. PII Deanonymization (Output Transform)
+    3. PII Deanonymization (Output Transform, applied while the response streams)
     """
     
-    def __init__(self):
-        self.pii_vault = PIIVault()
-        self.security_scanner = SecurityScanner()
+    def __init__(self, vault: Optional[PIIVault] = None, scanner: Optional[SecurityScanner] = None):
+        """
+        Args:
+            vault: PIIVault to use. Defaults to the process-wide shared vault.
+            scanner: SecurityScanner to use. Defaults to the process-wide shared scanner.
+        """
+        self.pii_vault = vault if vault is not None else get_vault()
+        self.security_scanner = scanner if scanner is not None else get_scanner()
+
+    def _vault_restores(self, anonymized_content: str, source_digest: str, session_id: str) -> bool:
+        """
+        Check that the session still maps every placeholder in a previously anonymized message,
+        i.e. deanonymizing it gives back the original text. False once the session has expired.
+        """
+        restored = self.pii_vault.deanonymize(anonymized_content, session_id)
+        return hashlib.sha256(restored.encode()).hexdigest() == source_digest
 
     def create_secure_chain(self, llm: BaseChatModel) -> RunnableSerializable:
         """
@@ -80,11 +95,25 @@ class SecureChainFactory:
                     raise ValueError("Security Alert: Malicious prompt detected.")
             
             # 2. Anonymize PII
-            # We need to reconstruct the messages with anonymized content
+            # We need to reconstruct the messages with anonymized content.
+            # Messages from earlier turns were tagged when first anonymized, so
+            # only new messages (normally just the latest one) go through Presidio.
             anonymized_messages = []
             for msg in messages:
                 if isinstance(msg, HumanMessage) and isinstance(msg.content, str):
-                    anonymized_content = self.pii_vault.anonymize(msg.content, session_id)
+                    source_digest = hashlib.sha256(msg.content.encode()).hexdigest()
+                    tag = msg.additional_kwargs.get(PII_SCANNED_KEY)
+                    if tag and tag["session_id"] == session_id and tag.get("source_digest") == source_digest \
+                            and self._vault_restores(tag["content"], source_digest, session_id):
+                        anonymized_content = tag["content"]
+                    else:
+                        anonymized_content = self.pii_vault.anonymize(msg.content, session_id)
+                        # Only a digest of the raw text is kept, the tag may be persisted by history stores
+                        msg.additional_kwargs[PII_SCANNED_KEY] = {
+                            "session_id": session_id,
+                            "source_digest": source_digest,
+                            "content": anonymized_content,
+                        }
                     anonymized_messages.append(HumanMessage(content=anonymized_content))
                 else:
                     anonymized_messages.append(msg)
@@ -94,40 +123,52 @@ class SecureChainFactory:
                 "session_id": session_id
             }
 
-        def call_llm(data: Dict[str, Any]) -> Dict[str, Any]:
+        def restore_chunk(chunk: AIMessageChunk, deanonymizer) -> Optional[AIMessageChunk]:
             """
-            Step 2: Call the LLM
+            Deanonymize one streamed chunk. Returns None while the text is held back.
             """
-            messages = data["messages"]
-            session_id = data["session_id"]
-            
-            logger.info(f"Forwarding to LLM (Session {session_id})...")
-            response = llm.invoke(messages)
-            
-            return {
-                "response": response,
-                "session_id": session_id
-            }
+            if isinstance(chunk.content, str):
+                content = deanonymizer.feed(chunk.content)
+                return AIMessageChunk(content=content) if content else None
+            return chunk
 
-        def output_guard(data: Dict[str, Any]) -> AIMessage:
+        def stream_llm(inputs: Iterator[Dict[str, Any]]) -> Iterator[AIMessageChunk]:
             """
-            Step 3: Deanonymize Output
+            Step 2 + 3: Stream the LLM response, deanonymizing it chunk by chunk
             """
-            response = data["response"]
-            session_id = data["session_id"]
-            
-            if isinstance(response, AIMessage) and isinstance(response.content, str):
-                logger.info(f"Deanonymizing response (Session {session_id})...")
-                deanonymized_content = self.pii_vault.deanonymize(response.content, session_id)
-                return AIMessage(content=deanonymized_content)
-            
-            return response
+            for data in inputs:
+                messages = data["messages"]
+                session_id = data["session_id"]
+                deanonymizer = self.pii_vault.streaming_deanonymizer(session_id)
+                
+                logger.info(f"Forwarding to LLM and deanonymizing response stream (Session {session_id})...")
+                for chunk in llm.stream(messages):
+                    restored = restore_chunk(chunk, deanonymizer)
+                    if restored is not None:
+                        yield restored
+                yield AIMessageChunk(content=deanonymizer.flush())
+
+        async def astream_llm(inputs: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[AIMessageChunk]:
+            """
+            Async variant of stream_llm, used by ainvoke/astream.
+            """
+            async for data in inputs:
+                messages = data["messages"]
+                session_id = data["session_id"]
+                deanonymizer = self.pii_vault.streaming_deanonymizer(session_id)
+                
+                logger.info(f"Forwarding to LLM and deanonymizing response stream (Session {session_id})...")
+                async for chunk in llm.astream(messages):
+                    restored = restore_chunk(chunk, deanonymizer)
+                    if restored is not None:
+                        yield restored
+                yield AIMessageChunk(content=deanonymizer.flush())
 
         # Compose the chain
+        # invoke() concatenates the streamed chunks into a single AIMessageChunk
         chain = (
             RunnableLambda(input_guard) 
-            | RunnableLambda(call_llm) 
-            | RunnableLambda(output_guard)
+            | RunnableGenerator(stream_llm, astream_llm)
         )
         
         return chain
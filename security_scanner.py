@@ -1,24 +1,64 @@
+import asyncio
+import os
 import re
+import threading
+import time
 import torch
-from transformers import DistilBertTokenizer, DistilBertForSequenceClassification
-from transformers import pipeline
+from typing import List, Optional
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Micro-batching for the async ML scan: up to SCAN_BATCH_SIZE prompts
+# arriving within SCAN_BATCH_MS are classified in a single forward pass.
+SCAN_BATCH_SIZE = int(os.getenv("SCAN_BATCH_SIZE", "16"))
+SCAN_BATCH_MS = float(os.getenv("SCAN_BATCH_MS", "5"))
+# Set SCAN_QUANTIZE=0 to keep the FP32 model.
+SCAN_QUANTIZE = os.getenv("SCAN_QUANTIZE", "1") == "1"
+# Dedicated prompt-injection classifier and the INJECTION probability above which a prompt is blocked.
+SCAN_MODEL_NAME = os.getenv("SCAN_MODEL_NAME", "protectai/deberta-v3-base-prompt-injection")
+SCAN_INJECTION_THRESHOLD = float(os.getenv("SCAN_INJECTION_THRESHOLD", "0.9"))
+# Set SCAN_TORCHSCRIPT=0 to skip tracing the model to frozen TorchScript graphs.
+SCAN_TORCHSCRIPT = os.getenv("SCAN_TORCHSCRIPT", "1") == "1"
+# Batches are padded to the smallest bucket that fits, so the model only ever sees
+# these sequence lengths and CPU kernels (and traced graphs) are reused across requests.
+SCAN_BUCKETS = [64, 128, 256, 512]
+# SCAN_MODE=full runs regex + ML, SCAN_MODE=regex skips the ML layer entirely.
+# Prompts shorter than SCAN_MIN_CHARS characters or SCAN_MIN_WORDS words skip the ML layer.
+SCAN_MODE = os.getenv("SCAN_MODE", "full")
+SCAN_MIN_CHARS = int(os.getenv("SCAN_MIN_CHARS", "16"))
+SCAN_MIN_WORDS = int(os.getenv("SCAN_MIN_WORDS", "4"))
+# After a failed model load, ML checks fail fast for this many seconds before loading is retried.
+SCAN_LOAD_RETRY_SECONDS = float(os.getenv("SCAN_LOAD_RETRY_SECONDS", "60"))
+
+# Process-wide scanner shared by the gateway and the LangChain integration, see get_scanner()
+_SCANNER = None
+_SCANNER_LOCK = threading.Lock()
+
+def get_scanner() -> "SecurityScanner":
+    """
+    Return the shared SecurityScanner, creating it on first use.
+    """
+    global _SCANNER
+    with _SCANNER_LOCK:
+        if _SCANNER is None:
+            _SCANNER = SecurityScanner()
+        return _SCANNER
+
 class SecurityScanner:
     """
     A multi-layered security scanner for LLM prompts.
     Layer 1: Regex-based Prompt Injection Detection.
-    Layer 2: ML-based Toxicity/Malicious Intent Detection (CPU optimized).
+    Layer 2: ML-based Prompt Injection Classification (CPU optimized).
     """
 
     def __init__(self):
         """
         Initialize the Security Scanner.
-        Loads the ML model for toxicity detection.
+        The ML model for prompt injection classification is loaded on first use, see `load`.
         """
         self.device = torch.device("cpu")
         logger.info(f"Initializing SecurityScanner on device: {self.device}")
@@ -37,22 +77,82 @@ class SecurityScanner:
             r"unfiltered",
             r"dan mode"
         ]
-        self.compiled_patterns = [re.compile(p, re.IGNORECASE) for p in self.injection_patterns]
+        # Fused into a single alternation so each prompt is scanned in one pass
+        self.fused_pattern = re.compile("|".join(f"(?:{p})" for p in self.injection_patterns), re.IGNORECASE)
+
+        # Layer 2: ML Model for Prompt Injection (loaded lazily)
+        self.tokenizer = None
+        self.model = None
+        self.traced_models = {}
+        self._loaded = False
+        # Last load failure and when loading may be tried again. Until then every ML check
+        # raises straight away rather than re-downloading the model per prompt; a transient
+        # failure (e.g. a download error) therefore disables the ML layer for SCAN_LOAD_RETRY_SECONDS.
+        self._load_error: Optional[Exception] = None
+        self._load_retry_at = 0.0
+        self._load_lock = threading.Lock()
+
+        # Batching queue, created lazily on the running event loop
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_loop = None
+        self._batch_task = None
+
+    def load(self):
+        """
+        Load, quantize, trace and warm up the ML model. Runs once; the ML check calls it
+        on first use, and servers can call it at startup to keep it off the request path.
+        """
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            # A failed load is not retried on every prompt. Raise a new exception each time:
+            # re-raising the cached one would grow its traceback, and keep every caller's prompt alive.
+            if self._load_error is not None and time.monotonic() < self._load_retry_at:
+                raise RuntimeError("ML model failed to load") from self._load_error
+            try:
+                self._load_model()
+            except Exception as e:
+                self._load_error = e
+                self._load_retry_at = time.monotonic() + SCAN_LOAD_RETRY_SECONDS
+                raise RuntimeError("ML model failed to load") from e
+            self._load_error = None
+            self._loaded = True
 
-        # Layer 2: ML Model for Toxicity/Malicious Intent
-        model_name = "distilbert-base-uncased-finetuned-sst-2-english"
+    def _load_model(self):
+        """
+        Internal method behind `load`. Caller must hold self._load_lock.
+        """
+        model_name = SCAN_MODEL_NAME
         logger.info(f"Loading ML model: {model_name}")
-        
+
         try:
-            self.tokenizer = DistilBertTokenizer.from_pretrained(model_name)
-            self.model = DistilBertForSequenceClassification.from_pretrained(model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            # torchscript=True makes the model return plain tuples, which tracing requires
+            self.model = AutoModelForSequenceClassification.from_pretrained(model_name, torchscript=SCAN_TORCHSCRIPT)
+            self.injection_label_id = self.model.config.label2id["INJECTION"]
             self.model.to(self.device)
             self.model.eval()
+            if SCAN_QUANTIZE:
+                # INT8 dynamic quantization of the Linear layers for faster CPU inference
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
             logger.info("ML model loaded successfully.")
         except Exception as e:
             logger.error(f"Failed to load ML model: {e}")
             raise e
 
+        # One traced graph per bucket length, kept only if it matches the eager model on a multi-row batch
+        self.traced_models = {}
+        if SCAN_TORCHSCRIPT:
+            for length in SCAN_BUCKETS:
+                traced = self._trace_model(length)
+                if traced is not None and self._validate_traced(traced, length):
+                    self.traced_models[length] = traced
+
+        # Warm up once so kernel selection happens before the first request
+        self._score_batch(["warmup"])
+
     def scan(self, text: str) -> bool:
         """
         Scan the text for security threats.
@@ -64,14 +164,13 @@ class SecurityScanner:
             True if the text is SAFE, False if MALICIOUS.
         """
         # Layer 1: Regex Check
-        for pattern in self.compiled_patterns:
-            if pattern.search(text):
-                logger.warning(f"Prompt Injection detected via regex: {pattern.pattern}")
-                return False
+        if not self._check_regex(text):
+            return False
+
+        if not self._needs_ml(text):
+            return True
 
         # Layer 2: ML Check
-        # We interpret "Negative" sentiment with high confidence as potentially malicious for this MVP demo.
-        # In a real system, we would use a dedicated Prompt Injection classifier.
         is_safe_ml = self._check_ml(text)
         if not is_safe_ml:
              logger.warning("Malicious intent detected via ML model.")
@@ -79,33 +178,228 @@ class SecurityScanner:
 
         return True
 
-    def _check_ml(self, text: str) -> bool:
+    async def scan_async(self, text: str) -> bool:
         """
-        Internal method to check text using the loaded ML model.
+        Async variant of `scan`. Concurrent calls are micro-batched so the
+        ML model runs one forward pass for several prompts.
+
+        Args:
+            text: The input prompt to scan.
+
+        Returns:
+            True if the text is SAFE, False if MALICIOUS.
+        """
+        if not self._check_regex(text):
+            return False
+
+        if not self._needs_ml(text):
+            return True
+
+        loop = asyncio.get_running_loop()
+        if self._batch_loop is not loop:
+            self._batch_queue = asyncio.Queue()
+            self._batch_loop = loop
+            self._batch_task = loop.create_task(self._batch_worker())
+
+        future = loop.create_future()
+        await self._batch_queue.put((text, future))
+        injection_score = await future
+
+        if injection_score is not None and not self._is_safe_score(text, injection_score):
+            logger.warning("Malicious intent detected via ML model.")
+            return False
+
+        return True
+
+    async def aclose(self):
+        """
+        Stop the batching task started by `scan_async`. Call from the event loop
+        it runs on (e.g. at server shutdown); prompts still queued or in the batch
+        being scored are cancelled.
+        """
+        task, queue = self._batch_task, self._batch_queue
+        self._batch_task = self._batch_queue = self._batch_loop = None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        while not queue.empty():
+            _, future = queue.get_nowait()
+            future.cancel()
+
+    async def _batch_worker(self):
+        """
+        Drain the queue in batches of up to SCAN_BATCH_SIZE prompts, waiting
+        at most SCAN_BATCH_MS after the first one, and resolve their futures.
+        """
+        loop = asyncio.get_running_loop()
+        queue = self._batch_queue
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + SCAN_BATCH_MS / 1000
+            while len(batch) < SCAN_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Load errors are not failed open: they propagate to every caller in the batch
+            try:
+                await asyncio.to_thread(self.load)
+            except asyncio.CancelledError:
+                self._cancel_batch(batch)
+                raise
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            texts = [text for text, _ in batch]
+            try:
+                scores = await asyncio.to_thread(self._score_batch, texts)
+            except asyncio.CancelledError:
+                self._cancel_batch(batch)
+                raise
+            except Exception as e:
+                # Fail open, same as the synchronous path
+                logger.error(f"Error during ML scan: {e}")
+                scores = [None] * len(batch)
+
+            for (_, future), score in zip(batch, scores):
+                if not future.done():
+                    future.set_result(score)
+
+    @staticmethod
+    def _cancel_batch(batch):
+        """
+        Cancel the unresolved futures of a batch the worker was processing when it was cancelled.
+        """
+        for _, future in batch:
+            if not future.done():
+                future.cancel()
+
+    def _needs_ml(self, text: str) -> bool:
+        """
+        Internal method to decide whether a regex-clean text still needs the ML check.
+        Very short prompts are treated as safe without running the model.
+        """
+        if SCAN_MODE == "regex":
+            return False
+        return len(text) >= SCAN_MIN_CHARS and len(text.split()) >= SCAN_MIN_WORDS
+
+    def _check_regex(self, text: str) -> bool:
+        """
+        Internal method to check text against the prompt injection patterns.
+        """
+        match = self.fused_pattern.search(text)
+        if match:
+            logger.warning(f"Prompt Injection detected via regex: {match.group(0)}")
+            return False
+        return True
+
+    def _trace_model(self, length: int):
+        """
+        Trace the model to TorchScript for inputs padded to `length` tokens and freeze it,
+        letting the JIT fuse ops and skip Python dispatch. Returns None if tracing fails.
+        """
+        example = self.tokenizer("warmup", return_tensors="pt", padding="max_length", max_length=length)
+        try:
+            with torch.no_grad():
+                traced = torch.jit.trace(
+                    self.model, (example["input_ids"], example["attention_mask"]), strict=False
+                )
+                traced = torch.jit.freeze(traced)
+            logger.info(f"ML model traced to TorchScript (sequence length {length}).")
+            return traced
+        except Exception as e:
+            logger.warning(f"TorchScript tracing failed, using eager model: {e}")
+            return None
+
+    def _validate_traced(self, traced, length: int) -> bool:
         """
+        Run a traced graph on a batch of two prompts padded to `length` tokens and compare
+        its logits with the eager model. Tracing records the example's shape, so a graph that
+        errors or disagrees on a different batch size is rejected here rather than at request time.
+        """
+        example = self.tokenizer(
+            ["warmup", "please summarise the following document for me"],
+            return_tensors="pt", padding="max_length", truncation=True, max_length=length,
+        )
+        inputs = {k: v.to(self.device) for k, v in example.items()}
         try:
-            inputs = self.tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=512)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            
             with torch.no_grad():
+                traced_logits = traced(inputs["input_ids"], inputs["attention_mask"])[0]
+                eager_logits = self.model(**inputs)[0]
+            if traced_logits.shape == eager_logits.shape and torch.allclose(traced_logits, eager_logits, atol=1e-3):
+                return True
+            logger.warning(f"TorchScript graph for sequence length {length} disagrees with the eager model, dropping it.")
+        except Exception as e:
+            logger.warning(f"TorchScript graph for sequence length {length} failed validation, dropping it: {e}")
+        return False
+
+    def _score_batch(self, texts: List[str]) -> List[float]:
+        """
+        Run the ML model over a batch of texts and return the INJECTION probability of each.
+        Assumes `load` has succeeded.
+        """
+        inputs = self.tokenizer(texts, return_tensors="pt", truncation=True, padding=True, max_length=SCAN_BUCKETS[-1])
+
+        # Pad the whole batch up to its bucket length
+        length = inputs["input_ids"].shape[1]
+        bucket = next(b for b in SCAN_BUCKETS if b >= length)
+        pad = bucket - length
+        if pad:
+            inputs = {
+                k: torch.nn.functional.pad(v, (0, pad), value=self.tokenizer.pad_token_id if k == "input_ids" else 0)
+                for k, v in inputs.items()
+            }
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+
+        traced = self.traced_models.get(bucket)
+        outputs = None
+        with torch.no_grad():
+            if traced is not None:
+                try:
+                    outputs = traced(inputs["input_ids"], inputs["attention_mask"])
+                except Exception as e:
+                    # Never let a bad graph reach the fail-open handler; stop using it
+                    logger.warning(f"TorchScript graph for sequence length {bucket} failed, using eager model: {e}")
+                    self.traced_models.pop(bucket, None)
+            if outputs is None:
                 outputs = self.model(**inputs)
-            
-            logits = outputs.logits
-            probabilities = torch.softmax(logits, dim=1)
-            
-            # In SST-2: Label 0 is NEGATIVE, Label 1 is POSITIVE.
-            # We'll assume highly negative prompts might be aggressive/malicious.
-            negative_score = probabilities[0][0].item()
-            
-            logger.info(f"ML Scan - Text: '{text[:30]}...' | Negative Score: {negative_score:.4f}")
-            
-            # Threshold: If > 99% negative, flag it.
-            # Increased from 0.95 to 0.99 to reduce false positives on neutral text.
-            if negative_score > 0.99:
-                return False
-            
-            return True
 
+        # First output is the logits, for both traced (tuple) and eager models
+        logits = outputs[0]
+        probabilities = torch.softmax(logits, dim=1)
+
+        return probabilities[:, self.injection_label_id].tolist()
+
+    def _is_safe_score(self, text: str, injection_score: float) -> bool:
+        """
+        Internal method to apply the ML threshold to an injection score.
+        """
+        logger.info(f"ML Scan - Text: '{text[:30]}...' | Injection Score: {injection_score:.4f}")
+
+        # Threshold: If the classifier is more than SCAN_INJECTION_THRESHOLD sure it is an injection, flag it.
+        return injection_score <= SCAN_INJECTION_THRESHOLD
+
+    def _check_ml(self, text: str) -> bool:
+        """
+        Internal method to check text using the loaded ML model.
+        Raises if the model cannot be loaded; only inference errors fail open.
+        """
+        self.load()
+        try:
+            injection_score = self._score_batch([text])[0]
         except Exception as e:
             logger.error(f"Error during ML scan: {e}")
             return True
+
+        return self._is_safe_score(text, injection_score)
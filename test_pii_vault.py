@@ -0,0 +1,213 @@
+import time
+from types import SimpleNamespace
+
+import diskcache
+import pytest
+
+from pii_vault import PIIVault
+
+
+class FakeAnalyzer:
+    """
+    Stands in for Presidio's AnalyzerEngine: flags the given words, no spaCy model needed.
+    Results use an entity type without a Faker generator, so placeholders look like <SECRET_xxxxxxxx>.
+    """
+
+    def __init__(self, words):
+        self.words = words
+        self.calls = 0
+
+    def analyze(self, text, entities, language):
+        self.calls += 1
+        results = []
+        for word in self.words:
+            start = text.find(word)
+            if start != -1:
+                results.append(SimpleNamespace(entity_type="SECRET", start=start, end=start + len(word)))
+        return results
+
+
+def make_vault(cache_dir, words=("Alice", "Bob")):
+    # Long flush interval so the background thread never flushes during a test
+    vault = PIIVault(cache_dir=str(cache_dir), flush_interval=3600)
+    vault.analyzer = FakeAnalyzer(list(words))
+    return vault
+
+
+@pytest.fixture
+def vault(tmp_path):
+    vault = make_vault(tmp_path)
+    yield vault
+    vault.close()
+    vault.vault_storage.close()
+
+
+def test_anonymize_deanonymize_round_trip(vault):
+    text = "Alice emailed Bob."
+    anonymized = vault.anonymize(text, "s1")
+    assert "Alice" not in anonymized and "Bob" not in anonymized
+    assert vault.deanonymize(anonymized, "s1") == text
+
+    # Other sessions cannot restore this session's placeholders
+    assert vault.deanonymize(anonymized, "s2") == anonymized
+
+    # New mappings in the same session are picked up by the cached matcher
+    second = vault.anonymize("Bob again", "s1")
+    assert vault.deanonymize(anonymized + " " + second, "s1") == text + " Bob again"
+
+
+def test_overlapping_detections_are_merged(tmp_path):
+    # A name inside an email, and a span that starts inside the name and runs past it
+    vault = make_vault(tmp_path, words=("anjali.gupta", "anjali.gupta@example.com", "gupta@example.com trailing"))
+    try:
+        text = "Mail anjali.gupta@example.com trailing text"
+        anonymized = vault.anonymize(text, "s1")
+        assert "anjali" not in anonymized and "example.com" not in anonymized and "trailing" not in anonymized
+        assert anonymized.endswith(" text")
+        assert vault.deanonymize(anonymized, "s1") == text
+    finally:
+        vault.close()
+        vault.vault_storage.close()
+
+
+def test_analyzer_results_are_cached(tmp_path):
+    vault = PIIVault(cache_dir=str(tmp_path), flush_interval=3600, analyze_cache_size=2)
+    vault.analyzer = analyzer = FakeAnalyzer(["Alice"])
+    try:
+        first = vault.anonymize("Hi Alice", "s1")
+        second = vault.anonymize("Hi Alice", "s1")
+        assert analyzer.calls == 1
+        # Placeholders are still generated per call
+        assert first != second
+
+        # Two more prompts push "Hi Alice" out of the two-entry cache
+        vault.anonymize("Hello Alice", "s1")
+        vault.anonymize("Bye Alice", "s1")
+        assert analyzer.calls == 3
+        vault.anonymize("Hi Alice", "s1")
+        assert analyzer.calls == 4
+    finally:
+        vault.close()
+        vault.vault_storage.close()
+
+
+def test_session_evicted_after_memory_check_is_reloaded(vault):
+    anonymized = vault.anonymize("Hi Alice", "s1")
+    vault.flush()
+
+    load_session = vault._load_session
+
+    def evict_after_check(session_id):
+        # Simulate the flusher evicting the session between the two lock sections
+        stored = load_session(session_id)
+        if stored is None:
+            with vault._lock:
+                vault._drop_session(session_id)
+        return stored
+
+    vault._load_session = evict_after_check
+    assert vault.deanonymize(anonymized, "s1") == "Hi Alice"
+
+    # anonymize keeps the earlier mappings instead of starting the session afresh
+    second = vault.anonymize("Hi Bob", "s1")
+    assert sorted(vault._mem["s1"].values()) == ["Alice", "Bob"]
+    vault._load_session = load_session
+    assert vault.deanonymize(anonymized + " " + second, "s1") == "Hi Alice Hi Bob"
+
+
+def test_failed_flush_is_retried(vault, monkeypatch):
+    anonymized = vault.anonymize("Hi Alice", "s1")
+
+    def failing_set(*args, **kwargs):
+        raise diskcache.Timeout()
+
+    monkeypatch.setattr(vault.vault_storage, "set", failing_set)
+    with pytest.raises(diskcache.Timeout):
+        vault.flush()
+    assert "s1" in vault._dirty
+    assert vault.vault_storage.get("session:s1") is None
+
+    monkeypatch.undo()
+    vault.flush()
+    assert not vault._dirty
+    stored = vault.vault_storage.get("session:s1")
+    assert list(stored.values()) == ["Alice"]
+    assert list(stored)[0] in anonymized
+
+
+def test_session_reloaded_from_disk_in_new_vault(tmp_path):
+    first = make_vault(tmp_path)
+    anonymized = first.anonymize("Alice met Bob", "s1")
+    first.close()
+    first.vault_storage.close()
+
+    second = make_vault(tmp_path)
+    try:
+        assert "s1" not in second._mem
+        assert second.deanonymize(anonymized, "s1") == "Alice met Bob"
+    finally:
+        second.close()
+        second.vault_storage.close()
+
+
+def test_expired_session_is_purged_lazily(vault):
+    anonymized = vault.anonymize("Hi Alice", "s1")
+    vault._expiry["s1"] = time.time() - 1
+
+    # Access purges the expired mapping instead of restoring from it
+    assert vault.deanonymize(anonymized, "s1") == anonymized
+    assert "s1" not in vault._mem
+    assert "s1" not in vault._dirty
+
+
+def test_lookup_of_unknown_session_is_not_cached(vault):
+    assert vault.deanonymize("nothing to restore", "unknown") == "nothing to restore"
+    assert "unknown" not in vault._mem
+    assert "unknown" not in vault._matchers
+
+
+def test_clean_sessions_beyond_cap_are_evicted(tmp_path):
+    vault = make_vault(tmp_path)
+    vault._max_sessions = 2
+    try:
+        anonymized = {s: vault.anonymize("Hi Alice", s) for s in ("s1", "s2", "s3")}
+        # Nothing is evicted before it is on disk
+        vault.flush()
+        assert len(vault._mem) == 3
+        vault.flush()
+        assert list(vault._mem) == ["s2", "s3"]
+
+        # The evicted session is reloaded from disk
+        assert vault.deanonymize(anonymized["s1"], "s1") == "Hi Alice"
+    finally:
+        vault.close()
+        vault.vault_storage.close()
+
+
+def test_expired_session_is_pruned_on_flush(vault):
+    vault.anonymize("Hi Alice", "s1")
+    vault._set_expiry("s1", time.time() - 1)
+
+    vault.flush()
+    assert "s1" not in vault._mem
+    assert vault.vault_storage.get("session:s1") is None
+
+
+def test_flush_merges_mappings_from_other_vaults(tmp_path):
+    # Two vaults sharing a cache directory, like two gateway workers
+    first = make_vault(tmp_path)
+    second = make_vault(tmp_path)
+    try:
+        from_first = first.anonymize("Hi Alice", "s1")
+        from_second = second.anonymize("Hi Bob", "s1")
+        first.flush()
+        second.flush()
+
+        stored = second.vault_storage.get("session:s1")
+        assert sorted(stored.values()) == ["Alice", "Bob"]
+        # The second vault picked up the first one's mapping while merging
+        assert second.deanonymize(from_first + " " + from_second, "s1") == "Hi Alice Hi Bob"
+    finally:
+        for vault in (first, second):
+            vault.close()
+            vault.vault_storage.close()
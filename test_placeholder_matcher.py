@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+import pii_vault
+from pii_vault import PlaceholderMatcher, StreamingDeanonymizer
+
+BACKENDS = ["ahocorasick", "regex"]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    if request.param == "ahocorasick":
+        if pii_vault.ahocorasick is None:
+            pytest.skip("pyahocorasick is not installed")
+    else:
+        monkeypatch.setattr(pii_vault, "ahocorasick", None)
+    return request.param
+
+
+def reference_sub(mapping, text):
+    """
+    Straightforward leftmost-longest replacement, used as the expected output.
+    """
+    placeholders = sorted(mapping, key=len, reverse=True)
+    parts = []
+    i = 0
+    while i < len(text):
+        for placeholder in placeholders:
+            if text.startswith(placeholder, i):
+                parts.append(mapping[placeholder])
+                i += len(placeholder)
+                break
+        else:
+            parts.append(text[i])
+            i += 1
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("mapping, text, expected", [
+    # Shorter placeholder inside a longer one that fails to match
+    ({"Priya Ramesh": "Alice Smith", "Ram": "Bob"}, "Thanks Priya Ram", "Thanks Priya Bob"),
+    ({"abab": "X", "b": "Y"}, "a_abaa", "a_aYaa"),
+    # Prefix-sharing placeholders prefer the longest
+    ({"Raj": "A", "Raj Kumar": "B"}, "Raj Kumar and Raj", "B and A"),
+    # Nested placeholders
+    ({"John": "J", "Mary John Doe": "M", "Doe": "D"}, "Mary John Doe, John Doe", "M, J D"),
+    # Match at the very end of the text
+    ({"x@y.com": "a@b.com"}, "mail x@y.com", "mail a@b.com"),
+    # Nothing to replace
+    ({"Bob": "Alice"}, "no names here", "no names here"),
+    ({}, "no placeholders", "no placeholders"),
+])
+def test_sub(backend, mapping, text, expected):
+    assert PlaceholderMatcher(mapping).sub(text) == expected
+
+
+def test_sub_matches_reference_fuzz(backend):
+    rng = random.Random(0)
+    for _ in range(500):
+        mapping = {
+            "".join(rng.choice("ab_") for _ in range(rng.randint(1, 5))): str(i)
+            for i in range(rng.randint(1, 4))
+        }
+        text = "".join(rng.choice("ab_") for _ in range(rng.randint(0, 20)))
+        assert PlaceholderMatcher(mapping).sub(text) == reference_sub(mapping, text), (mapping, text)
+
+
+def stream_sub(matcher, text, rng):
+    """
+    Feed the text to a StreamingDeanonymizer in random-sized chunks.
+    """
+    deanonymizer = StreamingDeanonymizer(matcher)
+    parts = []
+    i = 0
+    while i < len(text):
+        size = rng.randint(1, 6)
+        parts.append(deanonymizer.feed(text[i:i + size]))
+        i += size
+    parts.append(deanonymizer.flush())
+    return "".join(parts)
+
+
+def test_streaming_matches_sub(backend):
+    mapping = {"Priya Ramesh": "Alice Smith", "Ram": "Bob", "Raj": "A", "Raj Kumar": "B", "x@y.com": "a@b.com"}
+    text = "Thanks Priya Ram, Priya Ramesh and Raj Kumar. Raj mailed x@y.com"
+    matcher = PlaceholderMatcher(mapping)
+    rng = random.Random(1)
+    for _ in range(200):
+        assert stream_sub(matcher, text, rng) == matcher.sub(text)
+
+
+def test_streaming_matches_sub_fuzz(backend):
+    rng = random.Random(2)
+    for _ in range(500):
+        mapping = {
+            "".join(rng.choice("ab_") for _ in range(rng.randint(1, 5))): str(i)
+            for i in range(rng.randint(0, 4))
+        }
+        text = "".join(rng.choice("ab_") for _ in range(rng.randint(0, 30)))
+        matcher = PlaceholderMatcher(mapping)
+        assert stream_sub(matcher, text, rng) == matcher.sub(text), (mapping, text)